@@ -1,80 +1,450 @@
 import gradio as gr
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 import os
-import numpy as np
+import asyncio
+import httpx
 import chromadb
 import json
-from chromadb import Client as ChromaClient
-from chromadb.config import Settings
-from chromadb.utils import embedding_functions
+import orjson
+import re
+import hashlib
+import sqlite3
+import threading
+import time
+import sys
+from collections import OrderedDict
+from functools import lru_cache
+from chromadb.api.types import EmbeddingFunction
+from json_repair import repair_json
 from dotenv import load_dotenv
 
 load_dotenv(override=True)
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Keep-alive pool settings shared by the chat and embedding clients. Sized for
+# QUEUE_CONCURRENCY workers each running up to three parallel completions.
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+# The SDK retries 429/5xx with exponential backoff and honours Retry-After
+OPENAI_MAX_RETRIES = 5
+# Concurrent chat completions across all sessions, kept under the account's rate limit
+OPENAI_CONCURRENCY = 35
+# HTTP/2 multiplexes concurrent streams over one TLS connection
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS),
+    max_retries=OPENAI_MAX_RETRIES
+)
+openai_slots = asyncio.Semaphore(OPENAI_CONCURRENCY)
 
+EMBED_BACKEND = os.getenv("AEM_EMBED_BACKEND", "openai")  # "openai" or "local"
 EMBED_MODEL = "text-embedding-3-small"
+EMBED_DIMENSIONS = 512
+LOCAL_EMBED_MODEL = "BAAI/bge-small-en-v1.5"
 GEN_MODEL = "gpt-4o-mini"
+# Output caps bound worst-case latency: all three artifacts in JSON mode, one per parallel call
+MAX_OUTPUT_TOKENS = 6000
+ARTIFACT_MAX_TOKENS = 3000
+# Higher temperature for better adaptation while maintaining structure
+GENERATION_TEMPERATURE = 0.4
+# "single": one JSON-mode completion for all artifacts (names guaranteed consistent)
+# "parallel": one focused completion per artifact, run concurrently (lower wall-clock)
+GENERATION_MODE = os.getenv("AEM_GENERATION_MODE", "single")
+# Per-artifact models for parallel mode: dialog XML and HTL are near-mechanical
+# transforms of the field list, so only the Sling Model may warrant a larger model
+ARTIFACT_MODELS = {
+    "dialog": os.getenv("AEM_DIALOG_MODEL", GEN_MODEL),
+    "sling_model": os.getenv("AEM_SLING_MODEL", GEN_MODEL),
+    "htl": os.getenv("AEM_HTL_MODEL", GEN_MODEL),
+}
+# Streamed code is pushed to the UI at most this often, not on every token
+STREAM_UPDATE_SECONDS = 0.05
 CHUNK_SIZE = 800
-TOP_K = 10
+# The catalog is XML/Java snippets split on structural boundaries, so chunks need no
+# overlap; overlapping windows only re-embed the same lines twice
+CHUNK_OVERLAP = 0
+TOP_K = 3
+# Optional local cross-encoder that reorders the retrieved chunks, keeping RERANK_TOP_N
+RERANK = os.getenv("AEM_RERANK") == "1"
+RERANK_MODEL = "BAAI/bge-reranker-base"
+RERANK_TOP_N = 2
 CHROMA_DB_DIR = "rag_chroma_db_aem_new_2"
+# Set AEM_CHROMA_HOST to use a `chroma run` server instead of the in-process store
+CHROMA_HOST = os.getenv("AEM_CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("AEM_CHROMA_PORT", "8000"))
+# Vector size and distance space are part of the name so changing either builds a fresh collection
+COLLECTION_NAME = (
+    f"aem_rag_store_{EMBED_DIMENSIONS}_cosine" if EMBED_BACKEND == "openai"
+    else "aem_rag_store_bge_small_onnx_cosine"
+)
+# The index holds well under 1k chunks: a sparse graph and small search beam keep recall ~1.0
+HNSW_SETTINGS = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 8,
+    "hnsw:construction_ef": 64,
+    "hnsw:search_ef": 20,
+}
+# Chunker settings + file mtimes of the KB sources at the time they were last indexed
+CHUNKER_ID = f"recursive-{CHUNK_SIZE}-{CHUNK_OVERLAP}"
+INDEX_META_PATH = os.path.join(CHROMA_DB_DIR, f"{COLLECTION_NAME}_meta.json")
+ANSWER_CACHE_SIZE = 128
+# Generated answers also survive restarts here (most recent ANSWER_DISK_CACHE_SIZE kept)
+ANSWER_CACHE_PATH = os.path.join(CHROMA_DB_DIR, "answer_cache.sqlite3")
+ANSWER_DISK_CACHE_SIZE = 1000
+EMBED_CACHE_SIZE = 512
+# Embeddings survive restarts here, keyed by model + dimensions + text hash
+EMBED_CACHE_PATH = os.path.join(CHROMA_DB_DIR, "embedding_cache.sqlite3")
+ADD_BATCH_SIZE = 200
+BATCH_POLL_SECONDS = 30
+MAX_DISTANCE = 0.35  # cosine distance
+# Token budget for retrieved examples per request, and per field type within it
+MAX_CONTEXT_TOKENS = 1000
+TYPE_CONTEXT_TOKENS = 500
+TOKEN_ENCODING = "o200k_base"  # gpt-4o family tokenizer
+DEBUG = os.getenv("AEM_AGENT_DEBUG") == "1"
+QUEUE_CONCURRENCY = 8
+QUEUE_MAX_SIZE = 64
 
 # ---------- STEP 1: Initialize Chroma Client ----------
-chroma_client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+# The PersistentClient itself is opened lazily by get_collection()
+class OpenAIEmbedder(EmbeddingFunction):
+    """
+    Chroma embedding function on a sync OpenAI client with its own keep-alive
+    pool (Chroma calls embedding functions synchronously). Embeddings are kept
+    in an LRU keyed by text and in an on-disk SQLite cache, so repeated query
+    strings and unchanged chunks skip the API call, also after a restart.
+    """
+    def __init__(self):
+        self.client = OpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=httpx.Client(limits=HTTP_LIMITS),
+            max_retries=OPENAI_MAX_RETRIES
+        )
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        os.makedirs(CHROMA_DB_DIR, exist_ok=True)
+        self.disk_cache = sqlite3.connect(EMBED_CACHE_PATH, check_same_thread=False)
+        self.disk_cache.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB)")
+
+    @staticmethod
+    def disk_key(text):
+        return hashlib.sha256(f"{EMBED_MODEL}:{EMBED_DIMENSIONS}:{text}".encode("utf-8")).hexdigest()
+
+    def lookup(self, texts):
+        """Return {text: embedding} for the texts already cached in memory or on disk."""
+        with self.cache_lock:
+            found = {}
+            for text in texts:
+                if text in self.cache:
+                    self.cache.move_to_end(text)
+                    found[text] = self.cache[text]
+            
+            for text in dict.fromkeys(texts):
+                if text in found:
+                    continue
+                row = self.disk_cache.execute(
+                    "SELECT embedding FROM embeddings WHERE key = ?", (self.disk_key(text),)
+                ).fetchone()
+                if row:
+                    found[text] = self.cache[text] = orjson.loads(row[0])
+            
+            while len(self.cache) > EMBED_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return found
+
+    def store(self, embeddings):
+        """Keep {text: embedding} in the LRU and on disk."""
+        with self.cache_lock:
+            self.cache.update(embeddings)
+            with self.disk_cache:
+                self.disk_cache.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                    [(self.disk_key(text), orjson.dumps(embedding)) for text, embedding in embeddings.items()]
+                )
+            while len(self.cache) > EMBED_CACHE_SIZE:
+                self.cache.popitem(last=False)
+
+    def __call__(self, input):
+        found = self.lookup(input)
+        missing = [text for text in dict.fromkeys(input) if text not in found]
+        if missing:
+            response = self.client.embeddings.create(
+                model=EMBED_MODEL,
+                input=missing,
+                dimensions=EMBED_DIMENSIONS
+            )
+            fetched = dict(zip(missing, (item.embedding for item in response.data)))
+            self.store(fetched)
+            found.update(fetched)
+        return [found[text] for text in input]
 
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    model_name=EMBED_MODEL
-)
+class LocalEmbedder(EmbeddingFunction):
+    """
+    Chroma embedding function running a small quantized BGE model through
+    fastembed's ONNX runtime on CPU, so indexing and queries need no embeddings
+    API round-trip and no torch import.
+    """
+    def __init__(self):
+        from fastembed import TextEmbedding
+        self.model = TextEmbedding(model_name=LOCAL_EMBED_MODEL, providers=["CPUExecutionProvider"])
+
+    def __call__(self, input):
+        return [embedding.tolist() for embedding in self.model.embed(list(input))]
 
+def make_embedding_function():
+    if EMBED_BACKEND == "local":
+        return LocalEmbedder()
+    return OpenAIEmbedder()
+
+# Only the fields catalog is retrieved through RAG. The dialog/sling/htl reference
+# files are pinned whole into SYSTEM_PROMPT, indexing them too would send them twice.
 files_map = {
-    "dialog_template": "aem_knowledge_base/dialog_template.txt",
     "fields_catalog": "aem_knowledge_base/fields_catalog.txt",
-    "sling_examples": "aem_knowledge_base/sling_mappings.txt",
+}
+
+# Reference files pinned whole into SYSTEM_PROMPT
+REFERENCE_FILES = {
+    "dialog_template": "aem_knowledge_base/dialog_template.txt",
+    "sling_mappings": "aem_knowledge_base/sling_mappings.txt",
     "htl_snippets": "aem_knowledge_base/htl_snippets.txt",
 }
+KB_SNAPSHOT_PATH = os.path.join(CHROMA_DB_DIR, "kb_references.json")
+# Bump whenever compact_reference changes its output, so old snapshots are rebuilt
+COMPACTION_VERSION = 1
 
 # ---------- STEP 2: Build or Load Vector Store ----------
-def build_or_load_chroma():
+@lru_cache(maxsize=1)
+def get_text_splitter():
+    """
+    Prefer paragraph/line breaks, then statement and tag boundaries, so XML/Java/HTL
+    blocks are not cut mid-element. langchain is only imported when re-indexing.
+    """
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=["\n\n", "\n", ". ", ";", "{", "<", " ", ""]
+    )
+
+def chunk_text(text):
+    """Split text into structure-aware chunks."""
+    return get_text_splitter().split_text(text)
+
+def load_index_meta():
+    try:
+        with open(INDEX_META_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def embed_with_batch_api(texts, embedder):
+    """
+    Embed texts through the OpenAI Batch API (half the price of synchronous
+    calls, completes within 24h). Blocks while polling, so only used offline.
+    Texts already in the embedder's cache are not resubmitted, and the batch
+    results are written back to it for later queries and rebuilds.
+    """
+    found = embedder.lookup(texts)
+    missing = [text for text in dict.fromkeys(texts) if text not in found]
+    if found:
+        print(f"♻️ {len(found)} chunks served from the embedding cache")
+    if not missing:
+        return [found[text] for text in texts]
+    
+    batch_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=OPENAI_MAX_RETRIES)
+    lines = [
+        orjson.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/embeddings",
+            "body": {"model": EMBED_MODEL, "input": text, "dimensions": EMBED_DIMENSIONS},
+        })
+        for i, text in enumerate(missing)
+    ]
+    input_file = batch_client.files.create(file=("embeddings.jsonl", b"\n".join(lines)), purpose="batch")
+    batch = batch_client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/embeddings",
+        completion_window="24h"
+    )
+    print(f"⏳ Submitted embedding batch {batch.id} ({len(missing)} chunks)")
+    
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(BATCH_POLL_SECONDS)
+        batch = batch_client.batches.retrieve(batch.id)
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Embedding batch {batch.id} ended with status {batch.status}")
+    
+    embeddings = {}
+    for line in batch_client.files.content(batch.output_file_id).text.splitlines():
+        if not line:
+            continue
+        result = orjson.loads(line)
+        if result.get("error") or result["response"]["status_code"] != 200:
+            raise RuntimeError(f"Embedding batch {batch.id} failed for chunk {result['custom_id']}")
+        embeddings[int(result["custom_id"])] = result["response"]["body"]["data"][0]["embedding"]
+    fetched = {text: embeddings[i] for i, text in enumerate(missing)}
+    embedder.store(fetched)
+    found.update(fetched)
+    return [found[text] for text in texts]
+
+def build_or_load_chroma(use_batch_api=False):
     print("📦 Initializing or loading Chroma collection...")
+    if CHROMA_HOST:
+        chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+    else:
+        chroma_client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+    embedding_function = make_embedding_function()
     collection = chroma_client.get_or_create_collection(
-        name="aem_rag_store",
-        embedding_function=openai_ef
+        name=COLLECTION_NAME,
+        embedding_function=embedding_function,
+        metadata=HNSW_SETTINGS
     )
-    if collection.count() > 0:
+    
+    index_meta = load_index_meta()
+    indexed_mtimes = index_meta.get("mtimes", {})
+    current_mtimes = {
+        name: os.path.getmtime(path)
+        for name, path in files_map.items()
+        if os.path.exists(path)
+    }
+    same_chunker = index_meta.get("chunker") == CHUNKER_ID
+    index_current = same_chunker and indexed_mtimes == current_mtimes
+    # The meta sidecar is only written after a successful build and lives inside the
+    # local store, so it doubles as the "built" sentinel; a remote server is checked
+    if index_current and not CHROMA_HOST:
         print("✅ Existing Chroma collection loaded successfully.")
         return collection
     
-    print("📚 Building new Chroma collection from local files...")
-    for name, path in files_map.items():
-        if not os.path.exists(path):
+    # peek(limit=1) answers "is anything indexed" without counting every row
+    has_documents = bool(collection.peek(limit=1)["ids"])
+    if has_documents and index_current:
+        print("✅ Existing Chroma collection loaded successfully.")
+        return collection
+    
+    # Re-index only the sources whose file changed (or everything on first build / new chunker).
+    # Sources that are no longer in files_map are stale too, so their chunks get dropped.
+    indexed_sources = {meta["source"] for meta in collection.get(include=["metadatas"])["metadatas"]}
+    all_sources = sorted(set(files_map) | indexed_sources)
+    if has_documents and same_chunker:
+        stale_sources = [name for name in all_sources if indexed_mtimes.get(name) != current_mtimes.get(name)]
+    else:
+        stale_sources = all_sources
+    
+    print(f"📚 Indexing knowledge base files: {', '.join(stale_sources)}")
+    all_docs, all_metas, all_ids = [], [], []
+    for name in stale_sources:
+        existing_ids = set(collection.get(where={"source": name}, include=[])["ids"])
+        path = files_map.get(name)
+        if path is None:
+            text = ""
+        elif not os.path.exists(path):
             print(f"⚠️ File not found: {path}")
-            continue
-        with open(path, "r", encoding="utf-8") as f:
-            text = f.read()
+            text = ""
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
         
-        chunk_size = 800
-        overlap = 100
-        chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size - overlap)]
+        # Ids carry a content hash, so unchanged chunks keep their id and are not re-embedded
+        chunks_by_id = {
+            f"{name}_{hashlib.md5(chunk.encode('utf-8')).hexdigest()[:12]}": chunk
+            for chunk in chunk_text(text)
+        }
+        print(f"  - {name}: {len(chunks_by_id)} chunks")
+        removed_ids = existing_ids - chunks_by_id.keys()
+        if removed_ids:
+            collection.delete(ids=list(removed_ids))
         
-        for i, chunk in enumerate(chunks):
-            collection.add(
-                documents=[chunk],
-                metadatas=[{"source": name}],
-                ids=[f"{name}_{i}"]
-            )
+        for chunk_id, chunk in chunks_by_id.items():
+            if chunk_id in existing_ids:
+                continue
+            all_docs.append(chunk)
+            all_metas.append({"source": name})
+            all_ids.append(chunk_id)
+    
+    # Offline builds embed everything in one Batch API job up front
+    all_embeddings = None
+    if use_batch_api and EMBED_BACKEND == "openai" and all_docs:
+        all_embeddings = embed_with_batch_api(all_docs, embedding_function)
+    
+    # Upsert in batches so embeddings are requested per batch, not per chunk
+    for start in range(0, len(all_docs), ADD_BATCH_SIZE):
+        collection.upsert(
+            documents=all_docs[start:start + ADD_BATCH_SIZE],
+            metadatas=all_metas[start:start + ADD_BATCH_SIZE],
+            ids=all_ids[start:start + ADD_BATCH_SIZE],
+            embeddings=all_embeddings[start:start + ADD_BATCH_SIZE] if all_embeddings else None
+        )
     
-    print(f"✅ Vector store built with {collection.count()} documents.")
+    os.makedirs(CHROMA_DB_DIR, exist_ok=True)
+    with open(INDEX_META_PATH, "w", encoding="utf-8") as f:
+        json.dump({"chunker": CHUNKER_ID, "mtimes": current_mtimes}, f, indent=2)
+    
+    print(f"✅ Vector store updated: {len(all_ids)} new chunks, {collection.count()} documents total.")
     return collection
 
-collection = build_or_load_chroma()
+# The launch warm-up thread and the first request's retrieval can race; lru_cache
+# does not serialize a miss, so the build and the per-type table fill are guarded
+retrieval_lock = threading.RLock()
+
+@lru_cache(maxsize=1)
+def load_collection():
+    return build_or_load_chroma()
+
+def get_collection():
+    """Open (and if needed build) the Chroma collection on first use, not at import."""
+    with retrieval_lock:
+        return load_collection()
+
+@lru_cache(maxsize=1)
+def get_reranker():
+    """Load the cross-encoder once, only when reranking is enabled."""
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(RERANK_MODEL, device="cpu")
+
+def compact_reference(text):
+    """
+    Trim a reference file for the prompt: drop blank lines and halve the
+    indentation. Comments label the examples, so they are kept; only
+    whitespace tokens are saved.
+    """
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            continue
+        indent = len(line) - len(line.lstrip(" "))
+        lines.append(" " * (indent // 2) + stripped)
+    return "\n".join(lines)
+
+def load_reference_files():
+    """
+    Return the compacted reference files. They are stored together in one
+    snapshot next to the index and reused while the source mtimes and
+    COMPACTION_VERSION are unchanged, so a warm start is a single read + decode
+    instead of three reads and compactions.
+    """
+    mtimes = {name: os.path.getmtime(path) for name, path in REFERENCE_FILES.items()}
+    try:
+        with open(KB_SNAPSHOT_PATH, "rb") as f:
+            snapshot = orjson.loads(f.read())
+        if snapshot.get("mtimes") == mtimes and snapshot.get("compaction") == COMPACTION_VERSION:
+            return snapshot["references"]
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        pass
+    
+    references = {}
+    for name, path in REFERENCE_FILES.items():
+        with open(path, 'r', encoding='utf-8') as file:
+            references[name] = compact_reference(file.read())
+    
+    os.makedirs(CHROMA_DB_DIR, exist_ok=True)
+    with open(KB_SNAPSHOT_PATH, "wb") as f:
+        f.write(orjson.dumps({"mtimes": mtimes, "compaction": COMPACTION_VERSION, "references": references}))
+    return references
 
 try:
-    with open('aem_knowledge_base/dialog_template.txt', 'r', encoding='utf-8') as file:
-        dialog_template = file.read()
-    with open('aem_knowledge_base/sling_mappings.txt', 'r', encoding='utf-8') as file:
-        sling_mappings = file.read()
-    with open('aem_knowledge_base/htl_snippets.txt', 'r', encoding='utf-8') as file:
-        htl_snippets = file.read()
+    references = load_reference_files()
+    dialog_template = references["dialog_template"]
+    sling_mappings = references["sling_mappings"]
+    htl_snippets = references["htl_snippets"]
 except FileNotFoundError:
     print("Error: The file was not found.")
     dialog_template = ""
@@ -86,180 +456,398 @@ except Exception as e:
     sling_mappings = ""
     htl_snippets = ""
 
-def retrieve_targeted_context(fields, user_context=""):
-    """
-    Retrieve context using targeted queries that focus on structure patterns,
-    not specific field implementations
-    """
-    try:
-        all_retrieved = {
-            "dialog_context": "",
-            "sling_context": "",
-            "htl_context": "",
-            "fields_context": ""
-        }
-        
-        # Get unique field types
-        field_types_set = set(f['type'] for f in fields)
-        field_types_str = " ".join(field_types_set)
-        has_multifield = "Multifield" in field_types_set
-        
-        # Query 1: Dialog structure (focus on structure, not specific fields)
-        dialog_query = "dialog XML granite ui container tabs items structure"
-        dialog_results = collection.query(query_texts=[dialog_query], n_results=5)
-        dialog_docs = dialog_results.get("documents", [[]])[0]
-        all_retrieved["dialog_context"] = "\n\n".join(dialog_docs) if dialog_docs else ""
-        
-        # Query 2: Sling Model patterns (annotations and COMPLETE structure)
-        sling_query = "Sling Model @Model adaptables DefaultInjectionStrategy @ValueMapValue @Default complete class"
-        if has_multifield:
-            sling_query += " @ChildResource @PostConstruct ValueMap POJO inner class ArrayList multifield composite"
-        sling_results = collection.query(query_texts=[sling_query], n_results=8)
-        sling_docs = sling_results.get("documents", [[]])[0]
-        all_retrieved["sling_context"] = "\n\n".join(sling_docs) if sling_docs else ""
-        
-        # Query 3: HTL binding patterns
-        htl_query = "HTL data-sly-use model property access syntax"
-        htl_results = collection.query(query_texts=[htl_query], n_results=5)
-        htl_docs = htl_results.get("documents", [[]])[0]
-        all_retrieved["htl_context"] = "\n\n".join(htl_docs) if htl_docs else ""
-        
-        # Query 4: Field-specific examples (only for referenced field types)
-        if field_types_str:
-            fields_query = f"{field_types_str} sling:resourceType granite field properties"
-            fields_results = collection.query(query_texts=[fields_query], n_results=8)
-            fields_docs = fields_results.get("documents", [[]])[0]
-            all_retrieved["fields_context"] = "\n\n".join(fields_docs) if fields_docs else ""
-        
-        # Log what was retrieved
-        print(f"📚 Retrieved contexts:")
-        for key, value in all_retrieved.items():
-            print(f"  - {key}: {len(value)} chars")
-        
-        return all_retrieved
-        
-    except Exception as e:
-        print(f"❌ RAG Error: {str(e)}")
-        return {
-            "dialog_context": "",
-            "sling_context": "",
-            "htl_context": "",
-            "fields_context": ""
-        }
-        
-# --- UI Field Options ---
-field_types = [
-    "RTE Text Field",
-    "Drop down Field (Select)",
-    "Tags picker",
-    "Text Field",
-    "Text Area",
-    "Password Field",
-    "Number Field",
-    "Email Field",
-    "Date Picker",
-    "Color Field",
-    "Check Box",
-    "Path Field",
-    "Multifield"
-]
+# Static instructions, templates and examples. Built once so the system message is
+# byte-identical across requests and OpenAI can reuse the cached prompt prefix.
+SYSTEM_PROMPT = f"""You are an expert AEM developer. Generate code that implements user requirements exactly, using knowledge base examples as structural patterns. Prioritize user requirements over example patterns when they conflict. CRITICAL: Never omit fields from 'Fields to implement' list - all component-level fields must be included in Dialog XML, Sling Model (@ValueMapValue), and HTL (model.fieldName). If similar field types appear in both component fields and multifield context, include BOTH with different names: component field gets @ValueMapValue, multifield child goes in POJO only.
 
-fields_data = []
-extra_context = ""
+**YOUR TASK:**
+Generate complete, working AEM component code that implements EXACTLY the fields specified in the user message. Use the knowledge base references below and the field examples in the user message as REFERENCE PATTERNS for structure and syntax, but ADAPT them to match the specific fields and requirements provided.
 
+**CRITICAL RULES:**
+1. Implement ONLY the fields from the PRIMARY REQUIREMENTS in the user message
+2. NEVER skip or omit fields listed in "Fields to implement" - ALL must be included in dialog, Sling Model, and HTL
+3. For Sling Model: 
+   - REPLICATE the exact annotation pattern, imports, and class structure from "SLING MODEL REFERENCE" section
+   - Create @ValueMapValue for EVERY component-level field (Text, Dropdown, Color, CheckBox, etc.)
+   - Field names MUST match dialog "name" attributes exactly
+   - For multifield: ONLY create @ChildResource + POJO pattern (NO @ValueMapValue for child fields)
+4. For HTL:
+   - Display ALL component-level fields using ${{model.fieldName}}
+   - For multifield: iterate POJO list and access child fields via item
+   - NEVER confuse component field names with multifield child field names
+5. CAREFULLY distinguish between:
+   - Component-level fields (listed in "Fields to implement" - MUST ALL be in dialog, Sling Model @ValueMapValue, and HTL)
+   - Multifield container (if a Multifield type is listed)
+   - Multifield child fields (specified in user context, NOT in component fields list - go INSIDE multifield, in POJO only)
+6. If multifield child fields AND similar field types exist in component fields:
+   - These are SEPARATE fields that MUST BOTH be included
+   - Component field: uses exact name from "Fields to implement", has @ValueMapValue, displayed in HTL
+   - Multifield child: uses different name to avoid conflicts (e.g., "itemText" vs "text"), in POJO only, accessed via iteration
+7. For Dialog tabs: Parse user context for tab organization instructions
+   - Keywords: "separate tab", "in [TabName] tab", "Tab1", "Tab2", etc.
+   - Create appropriate tab structure with semantic node names and display titles
+   - If no tab instructions: use single "Properties" tab
+   - **CRITICAL:** Each tab MUST have full structure: tabNode → items → columns → items → column → items → [fields]
+   - NEVER put fields (including multifield) directly under tabs/items - always wrap in proper tab structure
+8. Dialog node names should be semantic (e.g., "title" for title field, not generic "item1")
+9. NO comments in any output
+10. NO extra methods beyond getters for the specified fields (no setters, no utility methods unless shown in pattern)
 
-# --- Gradio callbacks ---
-def add_field(selected_type, field_name, field_label, current_list):
-    if not field_name or not field_label:
-        return current_list, "⚠️ Please enter both a field name and label.", fields_data
+---
 
-    fields_data.append({
-        "type": selected_type,
-        "name": field_name,
-        "label": field_label
-    })
+**DIALOG TEMPLATE STRUCTURE:**
+{dialog_template}
 
-    new_entry = f"🧩 **{selected_type}** – Label: `{field_label}`, Name: `{field_name}`"
-    if current_list == "### 📋 Fields Added\n_(No fields added yet)_":
-        updated_list = f"### 📋 Fields Added\n\n{new_entry}"
-    else:
-        updated_list = current_list + "\n\n" + new_entry
+**SLING MODEL REFERENCE:**
+{sling_mappings}
 
-    return updated_list, f"✅ Added {selected_type} field successfully.", fields_data
+**HTL REFERENCE:**
+{htl_snippets}
+
+**GENERATION GUIDELINES:**
+
+Dialog XML:
+- Wrap fields in the dialog template structure shown above
+- Use semantic node names based on field purpose (e.g., "pageTitle", "description")
+- **INCLUDE ALL FIELDS from "Fields to implement"** - do not skip any component-level fields
+- **TAB ORGANIZATION:**
+  * **DEFAULT BEHAVIOR:**
+    - If context says "multifield in separate tab or add some fields in multifield" OR "separate tab": Create tabs according to number of mentioned in context
+      Based on the context add tab names. If nothing mentioned just add the one with data you have trained.
+    - If context specifies custom tab names (e.g., "in Configuration tab", "in Content tab"): Use those exact names and distribute fields as mentioned
+    - Only create multiple tabs if the user context explicitly mentions separate tabs or specific tab names.
+    - Otherwise, include ALL fields (including multifield) inside a single "Properties" tab.
+    - If NO tab mention: All fields in one "Properties" tab
+  * Tab node names should be lowercase/camelCase (e.g., properties, itemsTab, configuration)
+  * Tab titles (jcr:title) should be display-friendly (e.g., "Properties", "Items", "Configuration")
+  * **CRITICAL TAB STRUCTURE:** Each tab MUST follow this exact nesting:
+    ```
+    <tabNodeName jcr:primaryType="nt:unstructured" jcr:title="Display Name" sling:resourceType="granite/ui/components/coral/foundation/container" margin="{{Boolean}}true">
+        <items jcr:primaryType="nt:unstructured">
+            <columns jcr:primaryType="nt:unstructured" sling:resourceType="granite/ui/components/coral/foundation/fixedcolumns" margin="{{Boolean}}true">
+                <items jcr:primaryType="nt:unstructured">
+                    <column jcr:primaryType="nt:unstructured" sling:resourceType="granite/ui/components/coral/foundation/container">
+                        <items jcr:primaryType="nt:unstructured">
+                            <!-- YOUR FIELDS GO HERE -->
+                        </items>
+                    </column>
+                </items>
+            </columns>
+        </items>
+    </tabNodeName>
+    ```
+  * DO NOT put multifield directly as a tab sibling - it must be wrapped in a proper tab with the structure above
+  * Reference the provided Dialog Template for exact tab structure syntax
+- **For multifield composite structure:**
+  * The multifield itself is a component-level field (from "Fields to implement")
+  * Child fields specified in context go INSIDE the multifield composite node
+  * If multifield child fields have same TYPE as component fields → use different node names to avoid conflicts
+  * Example: Component has "text" field, multifield needs text field → use "itemText" or "fieldText" for multifield child
+  * Node naming for multifield children: semantic based on context (itemText, itemNumber, itemPath, etc.)
+- Properties: jcr:primaryType, sling:resourceType, fieldLabel, name
+
+**EXAMPLE TAB SCENARIOS:**
+
+Scenario 1: Context says "multifield in separate tab" or just "separate tab"
+Component fields: Text Field, Checkbox, Dropdown, Multifield
+→ Create 2 tabs:
+  - Tab 1 "Properties": Text Field, Checkbox, Dropdown (all non-multifield fields)
+  - Tab 2 "Items": Multifield only
+```
+<tabs>
+    <items>
+        <properties jcr:title="Properties">
+            <items><columns><items><column><items>
+                <text.../> <checkbox.../> <dropdown.../>
+            </items></column></items></columns></items>
+        </properties>
+        <itemsTab jcr:title="Items">
+            <items><columns><items><column><items>
+                <items (multifield)>...</items>
+            </items></column></items></columns></items>
+        </itemsTab>
+    </items>
+</tabs>
+```
+
+Scenario 2: "Put text and dropdown in Content tab, multifield in Configuration tab"
+→ Create 2 tabs with specified names:
+```
+<tabs>
+    <items>
+        <content jcr:title="Content">
+            <items><columns><items><column><items>
+                <text.../> <dropdown.../>
+            </items></column></items></columns></items>
+        </content>
+        <configuration jcr:title="Configuration">
+            <items><columns><items><column><items>
+                <multifield.../>
+            </items></column></items></columns></items>
+        </configuration>
+    </items>
+</tabs>
+```
+
+Scenario 3: No tab mention in context
+→ Create 1 tab: <properties jcr:title="Properties"> with ALL fields (including multifield) inside proper structure
+
+**CRITICAL:** Every tab needs: tabNode → items → columns → items → column → items → [your fields]
+DO NOT skip any of these nested levels!
+
+**EXAMPLE FIELD CONFLICT RESOLUTION:**
+Component fields: Text Field (name: text), Check Box (name: qsp), Multifield (name: items), Dropdown (name: color)
+Context: "Add text, number, path to multifield"
+
+**Dialog structure:**
+```
+<text name="./text" fieldLabel="Text Field"> (component field - MUST be included)
+<qsp name="./qsp"> (component field - MUST be included)
+<items> (multifield container)
+  <field name="./items">
+    <items>
+      <itemText name="./itemText"> (multifield child - different name!)
+      <itemNumber name="./itemNumber">
+      <itemPath name="./itemPath">
+    </items>
+  </field>
+</items>
+<color name="./color"> (component field - MUST be included)
+```
+
+**Sling Model:**
+```
+@ValueMapValue private String text;  // Component field
+@ValueMapValue private Boolean qsp;  // Component field
+@ValueMapValue private String color; // Component field
+
+@ChildResource(name = "items")
+private Resource itemsContainer;     // Multifield container
+
+private List<ItemData> items = new ArrayList<>();  // POJO list
+
+@PostConstruct
+protected void init() {{
+    // Build POJO list from multifield children
+}}
+
+public String getText() {{ return text; }}    // Component getter
+public Boolean getQsp() {{ return qsp; }}      // Component getter
+public String getColor() {{ return color; }}   // Component getter
+public List<ItemData> getItems() {{ return items; }}  // Multifield getter
+
+public static class ItemData {{
+    private final String itemText;      // Multifield child fields
+    private final Integer itemNumber;
+    private final String itemPath;
+    // Constructor and getters...
+}}
+```
+
+**HTL:**
+```
+<div data-sly-use.model="com.example.Model">
+    <p>Text: ${{model.text}}</p>        <!-- Component field -->
+    <p>QSP: ${{model.qsp}}</p>          <!-- Component field -->
+    <p>Color: ${{model.color}}</p>      <!-- Component field -->
+    
+    <ul data-sly-list.item="${{model.items}}">  <!-- Multifield iteration -->
+        <li>${{item.itemText}} - ${{item.itemNumber}} - ${{item.itemPath}}</li>
+    </ul>
+</div>
+```
+
+Note: ALL component fields (text, qsp, color) appear in all three files. Multifield children (itemText, itemNumber, itemPath) only in POJO and HTL iteration.
+
+Sling Model - FOLLOW KNOWLEDGE BASE PATTERN EXACTLY:
+- COPY the exact @Model annotation structure from the SLING MODEL REFERENCE above (including ALL parameters like adaptables, defaultInjectionStrategy, resourceType if present)
+- COPY the exact import statements from the pattern (including ArrayList, List, ValueMap, etc.)
+- COPY the package structure style from the pattern
+- **CREATE @ValueMapValue FOR ALL COMPONENT-LEVEL FIELDS** (from "Fields to implement"):
+  * Text Field → @ValueMapValue String fieldName; (use exact name from "Fields to implement")
+  * Dropdown → @ValueMapValue String fieldName;
+  * Color Field → @ValueMapValue String fieldName;
+  * Check Box → @ValueMapValue Boolean fieldName;
+  * Number Field → @ValueMapValue Integer fieldName;
+  * Date Picker → @ValueMapValue Date fieldName;
+  * Path Field → @ValueMapValue String fieldName;
+  * Tags picker → @ValueMapValue String[] fieldName;
+  * RTE Text Field → @ValueMapValue String fieldName;
+  * Text Area → @ValueMapValue String fieldName;
+  * Password Field → @ValueMapValue String fieldName;
+  * Email Field → @ValueMapValue String fieldName;
+  * Multifield → Use POJO pattern (see below)
+- **For multifield with child fields:**
+  * @ChildResource(name = "multifieldName") Resource containerResource; (use exact name from "Fields to implement")
+  * private List<PojoClass> multifieldList = new ArrayList<>(); (semantic name for the list)
+  * @PostConstruct init() method to populate the list
+  * Inner static POJO class with fields matching MULTIFIELD CHILD field names (NOT component field names)
+  * POJO field names should match the dialog node names used for multifield children (e.g., itemText, itemNumber, itemPath)
+  * Getter returns List<PojoClass> NOT List<Resource>
+- **Include getter for EVERY field:**
+  * Component-level fields: public Type getFieldName() {{ return fieldName; }}
+  * Multifield: public List<PojoClass> getMultifieldList() {{ return multifieldList; }}
+- Match the exact method signature style from pattern (public/private, return types, naming)
+- If pattern shows ComponentExporter, include it; otherwise use simpler pattern
+- Required imports for multifield: ArrayList, List, ValueMap, @PostConstruct, StringUtils or appropriate defaults
+
+**SLING MODEL FIELD MAPPING EXAMPLE:**
+If "Fields to implement" has: Text Field (name: text), Multifield (name: items)
+And context says: "Add text, number, path to multifield"
+Sling Model should have:
+```
+@ValueMapValue
+private String text;  // Component-level field
+
+@ChildResource(name = "items")
+private Resource itemsContainer;  // Multifield container
+
+private List<ItemData> items = new ArrayList<>();  // POJO list
+
+@PostConstruct
+protected void init() {{
+    if (itemsContainer != null) {{
+        for (Resource item : itemsContainer.getChildren()) {{
+            ValueMap vm = item.getValueMap();
+            items.add(new ItemData(
+                vm.get("itemText", ""),      // Multifield child field
+                vm.get("itemNumber", 0),     // Multifield child field
+                vm.get("itemPath", "")       // Multifield child field
+            ));
+        }}
+    }}
+}}
+
+public String getText() {{ return text; }}  // Component field getter
+public List<ItemData> getItems() {{ return items; }}  // Multifield getter
+
+public static class ItemData {{
+    private final String itemText;    // Multifield child fields
+    private final Integer itemNumber;
+    private final String itemPath;
+    // Constructor and getters...
+}}
+```
+
+HTL:
+- Use data-sly-use to bind Sling Model
+- Access properties as ${{model.propertyName}}
+- For multifield with POJO: iterate with data-sly-list="${{model.items}}" and access fields directly as ${{item.fieldName}}
+- Example: <li data-sly-list.item="${{model.items}}">${{item.text}} - ${{item.number}}</li>
+- No styling, no extra HTML structure
+- Follow the exact HTL syntax patterns from knowledge base
+
+**IMPORTANT FOR MULTIFIELD:**
+If a Multifield is in "Fields to implement" AND context specifies child fields:
+
+DIALOG STRUCTURE:
+```
+<items jcr:primaryType="nt:unstructured"
+       sling:resourceType="granite/ui/components/coral/foundation/form/multifield"
+       fieldLabel="Add Items">
+    <field jcr:primaryType="nt:unstructured"
+           sling:resourceType="granite/ui/components/coral/foundation/container"
+           name="./items">
+        <items jcr:primaryType="nt:unstructured">
+            <text .../>  <!-- Child fields go here -->
+            <number .../>
+            <path .../>
+        </items>
+    </field>
+</items>
+```
+
+SLING MODEL:
+```
+@ChildResource(name = "items")
+private List<Resource> items;
+
+public List<Resource> getItems() {{
+    return items;
+}}
+```
+NO separate @ValueMapValue fields for text/number/path - those are accessed via items.get(i).getValueMap().get("text")
+
+HTL ACCESS:
+```
+<ul data-sly-list.item="${{model.items}}">
+    <li>${{item.valueMap.text}} - ${{item.valueMap.number}} - ${{item.valueMap.path}}</li>
+</ul>
+```
+
+**SLING MODEL GENERATION CHECKLIST:**
+Before generating the Sling Model, verify you are:
+- ✓ Using the EXACT @Model annotation with ALL parameters from the knowledge base pattern
+- ✓ Including the EXACT import statements from the pattern
+- ✓ Using the EXACT package structure style from the pattern  
+- ✓ Following the EXACT annotation style for each field (@ValueMapValue, @Default, etc.)
+- ✓ Creating @ValueMapValue fields for EVERY component-level field from "Fields to implement" (count them and verify!)
+- ✓ Field names in Sling Model MUST match the "name" attribute from dialog exactly
+- ✓ For multifield: Creating POJO inner class + @PostConstruct init pattern
+- ✓ POJO fields match multifield child field names (e.g., itemText, itemNumber) NOT component field names (e.g., text)
+- ✓ Creating getter methods for ALL fields (component + multifield)
+- ✓ Multifield getter returns List<PojoClass>, NOT List<Resource>
+- ✓ Including only getter methods (no setters unless pattern shows them)
+
+**HTL GENERATION CHECKLIST:**
+Before generating HTL, verify you are:
+- ✓ Using data-sly-use to bind the Sling Model
+- ✓ Displaying ALL component-level fields from "Fields to implement" (count them and verify!)
+- ✓ Using ${{model.fieldName}} syntax for component fields
+- ✓ For multifield: Using data-sly-list to iterate the POJO list
+- ✓ Accessing multifield child fields via item POJO (e.g., ${{item.itemText}})
+- ✓ Not confusing component field names with multifield child field names"""
 
+# Output instructions are appended to the user message, so the system prefix stays
+# shared between the single JSON call and the per-artifact calls
+JSON_OUTPUT_FORMAT = """**OUTPUT FORMAT:**
+Return valid JSON only:
+{
+  "dialog": "<complete dialog XML>",
+  "sling_model": "<complete Java Sling Model>",
+  "htl": "<complete HTL template>"
+}"""
+
+# Strict structured output: the API guarantees exactly these three string keys
+ARTIFACT_SCHEMA = {
+    "name": "aem_component",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "dialog": {"type": "string"},
+            "sling_model": {"type": "string"},
+            "htl": {"type": "string"},
+        },
+        "required": ["dialog", "sling_model", "htl"],
+        "additionalProperties": False,
+    },
+}
 
-def reset_fields():
-    global fields_data, extra_context
-    fields_data = []
-    extra_context = ""
-    return "### 📋 Fields Added\n_(No fields added yet)_", "", "", "", ""
+ARTIFACT_OUTPUT_FORMATS = {
+    "dialog": "Return ONLY the complete dialog XML as plain text. No JSON, no markdown fences, no explanations.",
+    "sling_model": "Return ONLY the complete Java Sling Model class as plain text. No JSON, no markdown fences, no explanations.",
+    "htl": "Return ONLY the complete HTL template as plain text. No JSON, no markdown fences, no explanations.",
+}
 
 
-def set_context_chat(prompt):
-    global extra_context
-    extra_context = prompt
-    return f"🧠 Context added successfully:\n> {prompt}"
+# One case-insensitive scan for any tab-related phrase
+TAB_MENTION_PATTERN = re.compile("|".join(re.escape(keyword) for keyword in (
+    'separate tab', 'different tab', 'another tab', 'in a tab',
+    'tab with name', 'tab name as', 'tab named',
+    'configuration tab', 'content tab', 'properties tab',
+    'settings tab', 'data tab', 'additional tab'
+)), re.IGNORECASE)
 
-def generate_sling_model_with_rag(fields, user_context):
-    """
-    Generate code using knowledge base as reference patterns, not rigid templates
-    """
-    if not fields:
-        return ("⚠️ Please add at least one field before generating.", "", "")
+TAB_NAME_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r'tab (?:with )?name (?:as |is )?["\']?([A-Za-z\s]+)["\']?',
+    r'in (?:a |the )?["\']?([A-Za-z\s]+)["\']? tab',
+    r'separate tab (?:with name |as )?["\']?([A-Za-z\s]+)?["\']?',
+    r'another tab (?:with name |as )?["\']?([A-Za-z\s]+)?["\']?',
+)]
 
-    # Build field requirements
-    fields_list = []
-    multifield_info = {}
-    
-    for f in fields:
-        fields_list.append({
-            "type": f['type'],
-            "name": f['name'],
-            "label": f['label']
-        })
-        # Track multifield for special handling
-        if f['type'] == "Multifield":
-            multifield_info[f['name']] = {
-                "label": f['label'],
-                "child_fields": []
-            }
-    
-    fields_json = json.dumps(fields_list, indent=2)
-    
-    # Detect tab organization from context
-    tab_instructions = ""
-    if user_context:
-        context_lower = user_context.lower()
-        
-        # Check for any tab-related keywords
-        has_tab_mention = any(keyword in context_lower for keyword in [
-            'separate tab', 'different tab', 'another tab', 'in a tab',
-            'tab with name', 'tab name as', 'tab named',
-            'configuration tab', 'content tab', 'properties tab',
-            'settings tab', 'data tab', 'additional tab'
-        ])
-        
-        if has_tab_mention:
-            # Extract all mentioned tab names from context
-            import re
-            tab_patterns = [
-                r'tab (?:with )?name (?:as |is )?["\']?([A-Za-z\s]+)["\']?',
-                r'in (?:a |the )?["\']?([A-Za-z\s]+)["\']? tab',
-                r'separate tab (?:with name |as )?["\']?([A-Za-z\s]+)?["\']?',
-                r'another tab (?:with name |as )?["\']?([A-Za-z\s]+)?["\']?',
-            ]
-            
-            detected_tabs = []
-            for pattern in tab_patterns:
-                matches = re.findall(pattern, context_lower, re.IGNORECASE)
-                detected_tabs.extend([m.strip().title() for m in matches if m.strip()])
-            
-            # Remove duplicates while preserving order
-            detected_tabs = list(dict.fromkeys(detected_tabs))
-            
-            tab_analysis = f"Detected tab names from context: {', '.join(detected_tabs) if detected_tabs else 'No explicit names found'}"
-            
-            tab_instructions = f"""
+# Per-request prompt parts, filled with str.format_map (literal braces are doubled)
+TAB_INSTRUCTIONS_TEMPLATE = """
 **TAB ORGANIZATION DETECTED:**
 The user context mentions tab organization.
 
@@ -350,17 +938,10 @@ Context: "Add multifield in Items tab, Add email and path in Additional Details
 </tabs>
 ```
 """
-    
-    # Parse multifield child fields from context if mentioned
-    multifield_context_note = ""
-    if multifield_info and user_context:
-        # Extract component-level field names to avoid conflicts
-        component_field_names = [f['name'] for f in fields_list]
-        component_field_types = [f['type'] for f in fields_list]
-        
-        multifield_context_note = f"""
+
+MULTIFIELD_NOTE_TEMPLATE = """
 **MULTIFIELD STRUCTURE CLARIFICATION:**
-You have a Multifield component named: {', '.join(multifield_info.keys())}
+You have a Multifield component named: {multifield_names}
 The user context describes what fields go INSIDE this multifield (as child fields).
 
 CRITICAL: Component-level fields vs Multifield child fields:
@@ -400,412 +981,518 @@ Dialog should have:
     </field>
   </items>
 """
-    
-    # Retrieve relevant context
-    print("🔍 Retrieving context from trained knowledge base...")
-    rag_context = retrieve_targeted_context(fields, user_context)
-    
-    # Build clearer, prioritized prompt
-    full_prompt = f"""You are an expert AEM developer generating component code.
 
-**PRIMARY REQUIREMENTS (HIGHEST PRIORITY):**
+USER_PROMPT_TEMPLATE = """**PRIMARY REQUIREMENTS (HIGHEST PRIORITY):**
 Fields to implement:
 {fields_json}
 
 User requirements:
-{user_context if user_context else "No additional requirements - use standard AEM best practices."}
-
-{tab_instructions}
-
-{multifield_context_note}
-
-**YOUR TASK:**
-Generate complete, working AEM component code that implements EXACTLY the fields specified above. Use the knowledge base examples below as REFERENCE PATTERNS for structure and syntax, but ADAPT them to match the specific fields and requirements provided.
-
-**CRITICAL RULES:**
-1. Implement ONLY the fields from the PRIMARY REQUIREMENTS above
-2. NEVER skip or omit fields listed in "Fields to implement" - ALL must be included in dialog, Sling Model, and HTL
-3. For Sling Model: 
-   - REPLICATE the exact annotation pattern, imports, and class structure from "Sling Model Pattern" section
-   - Create @ValueMapValue for EVERY component-level field (Text, Dropdown, Color, CheckBox, etc.)
-   - Field names MUST match dialog "name" attributes exactly
-   - For multifield: ONLY create @ChildResource + POJO pattern (NO @ValueMapValue for child fields)
-4. For HTL:
-   - Display ALL component-level fields using ${{model.fieldName}}
-   - For multifield: iterate POJO list and access child fields via item
-   - NEVER confuse component field names with multifield child field names
-5. CAREFULLY distinguish between:
-   - Component-level fields (listed in "Fields to implement" - MUST ALL be in dialog, Sling Model @ValueMapValue, and HTL)
-   - Multifield container (if a Multifield type is listed)
-   - Multifield child fields (specified in user context, NOT in component fields list - go INSIDE multifield, in POJO only)
-6. If multifield child fields AND similar field types exist in component fields:
-   - These are SEPARATE fields that MUST BOTH be included
-   - Component field: uses exact name from "Fields to implement", has @ValueMapValue, displayed in HTL
-   - Multifield child: uses different name to avoid conflicts (e.g., "itemText" vs "text"), in POJO only, accessed via iteration
-7. For Dialog tabs: Parse user context for tab organization instructions
-   - Keywords: "separate tab", "in [TabName] tab", "Tab1", "Tab2", etc.
-   - Create appropriate tab structure with semantic node names and display titles
-   - If no tab instructions: use single "Properties" tab
-   - **CRITICAL:** Each tab MUST have full structure: tabNode → items → columns → items → column → items → [fields]
-   - NEVER put fields (including multifield) directly under tabs/items - always wrap in proper tab structure
-8. Dialog node names should be semantic (e.g., "title" for title field, not generic "item1")
-9. NO comments in any output
-10. NO extra methods beyond getters for the specified fields (no setters, no utility methods unless shown in pattern)
-
----
-
-**KNOWLEDGE BASE EXAMPLES (Use as patterns, not templates):**
-
-Dialog Structure Pattern:
-{rag_context['dialog_context'] if rag_context['dialog_context'] else "Use standard Granite UI container/tabs structure"}
-
-Field Type Examples:
-{rag_context['fields_context'] if rag_context['fields_context'] else "Use standard Granite UI field types"}
-
-Sling Model Pattern:
-{rag_context['sling_context'] if rag_context['sling_context'] else "Use @Model with adaptables=Resource.class and @ValueMapValue"}
-
-HTL Pattern:
-{rag_context['htl_context'] if rag_context['htl_context'] else "Use data-sly-use for model binding"}
-
----
-
-**DIALOG TEMPLATE STRUCTURE:**
-{dialog_template}
-
-**SLING MODEL REFERENCE:**
-{sling_mappings}
-
-**HTL REFERENCE:**
-{htl_snippets}
-
-**GENERATION GUIDELINES:**
-
-Dialog XML:
-- Wrap fields in the dialog template structure shown above
-- Use semantic node names based on field purpose (e.g., "pageTitle", "description")
-- **INCLUDE ALL FIELDS from "Fields to implement"** - do not skip any component-level fields
-- **TAB ORGANIZATION:**
-  * **DEFAULT BEHAVIOR:**
-    - If context says "multifield in separate tab or add some fields in multifield" OR "separate tab": Create tabs according to number of mentioned in context
-      Based on the context add tab names. If nothing mentioned just add the one with data you have trained.
-    - If context specifies custom tab names (e.g., "in Configuration tab", "in Content tab"): Use those exact names and distribute fields as mentioned
-    - Only create multiple tabs if the user context explicitly mentions separate tabs or specific tab names.
-    - Otherwise, include ALL fields (including multifield) inside a single "Properties" tab.
-    - If NO tab mention: All fields in one "Properties" tab
-  * Tab node names should be lowercase/camelCase (e.g., properties, itemsTab, configuration)
-  * Tab titles (jcr:title) should be display-friendly (e.g., "Properties", "Items", "Configuration")
-  * **CRITICAL TAB STRUCTURE:** Each tab MUST follow this exact nesting:
-    ```
-    <tabNodeName jcr:primaryType="nt:unstructured" jcr:title="Display Name" sling:resourceType="granite/ui/components/coral/foundation/container" margin="{{Boolean}}true">
-        <items jcr:primaryType="nt:unstructured">
-            <columns jcr:primaryType="nt:unstructured" sling:resourceType="granite/ui/components/coral/foundation/fixedcolumns" margin="{{Boolean}}true">
-                <items jcr:primaryType="nt:unstructured">
-                    <column jcr:primaryType="nt:unstructured" sling:resourceType="granite/ui/components/coral/foundation/container">
-                        <items jcr:primaryType="nt:unstructured">
-                            <!-- YOUR FIELDS GO HERE -->
-                        </items>
-                    </column>
-                </items>
-            </columns>
-        </items>
-    </tabNodeName>
-    ```
-  * DO NOT put multifield directly as a tab sibling - it must be wrapped in a proper tab with the structure above
-  * Reference the provided Dialog Template for exact tab structure syntax
-- **For multifield composite structure:**
-  * The multifield itself is a component-level field (from "Fields to implement")
-  * Child fields specified in context go INSIDE the multifield composite node
-  * If multifield child fields have same TYPE as component fields → use different node names to avoid conflicts
-  * Example: Component has "text" field, multifield needs text field → use "itemText" or "fieldText" for multifield child
-  * Node naming for multifield children: semantic based on context (itemText, itemNumber, itemPath, etc.)
-- Properties: jcr:primaryType, sling:resourceType, fieldLabel, name
-
-**EXAMPLE TAB SCENARIOS:**
-
-Scenario 1: Context says "multifield in separate tab" or just "separate tab"
-Component fields: Text Field, Checkbox, Dropdown, Multifield
-→ Create 2 tabs:
-  - Tab 1 "Properties": Text Field, Checkbox, Dropdown (all non-multifield fields)
-  - Tab 2 "Items": Multifield only
-```
-<tabs>
-    <items>
-        <properties jcr:title="Properties">
-            <items><columns><items><column><items>
-                <text.../> <checkbox.../> <dropdown.../>
-            </items></column></items></columns></items>
-        </properties>
-        <itemsTab jcr:title="Items">
-            <items><columns><items><column><items>
-                <items (multifield)>...</items>
-            </items></column></items></columns></items>
-        </itemsTab>
-    </items>
-</tabs>
-```
-
-Scenario 2: "Put text and dropdown in Content tab, multifield in Configuration tab"
-→ Create 2 tabs with specified names:
-```
-<tabs>
-    <items>
-        <content jcr:title="Content">
-            <items><columns><items><column><items>
-                <text.../> <dropdown.../>
-            </items></column></items></columns></items>
-        </content>
-        <configuration jcr:title="Configuration">
-            <items><columns><items><column><items>
-                <multifield.../>
-            </items></column></items></columns></items>
-        </configuration>
-    </items>
-</tabs>
-```
-
-Scenario 3: No tab mention in context
-→ Create 1 tab: <properties jcr:title="Properties"> with ALL fields (including multifield) inside proper structure
-
-**CRITICAL:** Every tab needs: tabNode → items → columns → items → column → items → [your fields]
-DO NOT skip any of these nested levels!
-
-**EXAMPLE FIELD CONFLICT RESOLUTION:**
-Component fields: Text Field (name: text), Check Box (name: qsp), Multifield (name: items), Dropdown (name: color)
-Context: "Add text, number, path to multifield"
-
-**Dialog structure:**
-```
-<text name="./text" fieldLabel="Text Field"> (component field - MUST be included)
-<qsp name="./qsp"> (component field - MUST be included)
-<items> (multifield container)
-  <field name="./items">
-    <items>
-      <itemText name="./itemText"> (multifield child - different name!)
-      <itemNumber name="./itemNumber">
-      <itemPath name="./itemPath">
-    </items>
-  </field>
-</items>
-<color name="./color"> (component field - MUST be included)
-```
-
-**Sling Model:**
-```
-@ValueMapValue private String text;  // Component field
-@ValueMapValue private Boolean qsp;  // Component field
-@ValueMapValue private String color; // Component field
-
-@ChildResource(name = "items")
-private Resource itemsContainer;     // Multifield container
-
-private List<ItemData> items = new ArrayList<>();  // POJO list
-
-@PostConstruct
-protected void init() {{
-    // Build POJO list from multifield children
-}}
-
-public String getText() {{ return text; }}    // Component getter
-public Boolean getQsp() {{ return qsp; }}      // Component getter
-public String getColor() {{ return color; }}   // Component getter
-public List<ItemData> getItems() {{ return items; }}  // Multifield getter
-
-public static class ItemData {{
-    private final String itemText;      // Multifield child fields
-    private final Integer itemNumber;
-    private final String itemPath;
-    // Constructor and getters...
-}}
-```
-
-**HTL:**
-```
-<div data-sly-use.model="com.example.Model">
-    <p>Text: ${{model.text}}</p>        <!-- Component field -->
-    <p>QSP: ${{model.qsp}}</p>          <!-- Component field -->
-    <p>Color: ${{model.color}}</p>      <!-- Component field -->
-    
-    <ul data-sly-list.item="${{model.items}}">  <!-- Multifield iteration -->
-        <li>${{item.itemText}} - ${{item.itemNumber}} - ${{item.itemPath}}</li>
-    </ul>
-</div>
-```
+{user_context}
 
-Note: ALL component fields (text, qsp, color) appear in all three files. Multifield children (itemText, itemNumber, itemPath) only in POJO and HTL iteration.
+{tab_instructions}
 
-Sling Model - FOLLOW KNOWLEDGE BASE PATTERN EXACTLY:
-- COPY the exact @Model annotation structure from the Sling Model Pattern above (including ALL parameters like adaptables, defaultInjectionStrategy, resourceType if present)
-- COPY the exact import statements from the pattern (including ArrayList, List, ValueMap, etc.)
-- COPY the package structure style from the pattern
-- **CREATE @ValueMapValue FOR ALL COMPONENT-LEVEL FIELDS** (from "Fields to implement"):
-  * Text Field → @ValueMapValue String fieldName; (use exact name from "Fields to implement")
-  * Dropdown → @ValueMapValue String fieldName;
-  * Color Field → @ValueMapValue String fieldName;
-  * Check Box → @ValueMapValue Boolean fieldName;
-  * Number Field → @ValueMapValue Integer fieldName;
-  * Date Picker → @ValueMapValue Date fieldName;
-  * Path Field → @ValueMapValue String fieldName;
-  * Tags picker → @ValueMapValue String[] fieldName;
-  * RTE Text Field → @ValueMapValue String fieldName;
-  * Text Area → @ValueMapValue String fieldName;
-  * Password Field → @ValueMapValue String fieldName;
-  * Email Field → @ValueMapValue String fieldName;
-  * Multifield → Use POJO pattern (see below)
-- **For multifield with child fields:**
-  * @ChildResource(name = "multifieldName") Resource containerResource; (use exact name from "Fields to implement")
-  * private List<PojoClass> multifieldList = new ArrayList<>(); (semantic name for the list)
-  * @PostConstruct init() method to populate the list
-  * Inner static POJO class with fields matching MULTIFIELD CHILD field names (NOT component field names)
-  * POJO field names should match the dialog node names used for multifield children (e.g., itemText, itemNumber, itemPath)
-  * Getter returns List<PojoClass> NOT List<Resource>
-- **Include getter for EVERY field:**
-  * Component-level fields: public Type getFieldName() {{ return fieldName; }}
-  * Multifield: public List<PojoClass> getMultifieldList() {{ return multifieldList; }}
-- Match the exact method signature style from pattern (public/private, return types, naming)
-- If pattern shows ComponentExporter, include it; otherwise use simpler pattern
-- Required imports for multifield: ArrayList, List, ValueMap, @PostConstruct, StringUtils or appropriate defaults
+{multifield_context_note}
 
-**SLING MODEL FIELD MAPPING EXAMPLE:**
-If "Fields to implement" has: Text Field (name: text), Multifield (name: items)
-And context says: "Add text, number, path to multifield"
-Sling Model should have:
-```
-@ValueMapValue
-private String text;  // Component-level field
+---
 
-@ChildResource(name = "items")
-private Resource itemsContainer;  // Multifield container
+**KNOWLEDGE BASE EXAMPLES (Use as patterns, not templates):**
 
-private List<ItemData> items = new ArrayList<>();  // POJO list
+Field Type Examples:
+{fields_context}
+"""
 
-@PostConstruct
-protected void init() {{
-    if (itemsContainer != null) {{
-        for (Resource item : itemsContainer.getChildren()) {{
-            ValueMap vm = item.getValueMap();
-            items.add(new ItemData(
-                vm.get("itemText", ""),      // Multifield child field
-                vm.get("itemNumber", 0),     // Multifield child field
-                vm.get("itemPath", "")       // Multifield child field
-            ));
-        }}
-    }}
-}}
 
-public String getText() {{ return text; }}  // Component field getter
-public List<ItemData> getItems() {{ return items; }}  // Multifield getter
+@lru_cache(maxsize=1)
+def get_token_encoder():
+    import tiktoken
+    return tiktoken.get_encoding(TOKEN_ENCODING)
 
-public static class ItemData {{
-    private final String itemText;    // Multifield child fields
-    private final Integer itemNumber;
-    private final String itemPath;
-    // Constructor and getters...
-}}
-```
+# Closest fields-catalog chunks per dropdown field type, filled on demand and warmed at launch
+field_type_examples = {}
 
-HTL:
-- Use data-sly-use to bind Sling Model
-- Access properties as ${{model.propertyName}}
-- For multifield with POJO: iterate with data-sly-list="${{model.items}}" and access fields directly as ${{item.fieldName}}
-- Example: <li data-sly-list.item="${{model.items}}">${{item.text}} - ${{item.number}}</li>
-- No styling, no extra HTML structure
-- Follow the exact HTL syntax patterns from knowledge base
+def lookup_field_types(types):
+    """
+    Return {field_type: closest chunks} for the given types. The dropdown offers a
+    fixed set of types, so this table stays small. All uncached types are embedded
+    and searched together in one batched Chroma query.
+    """
+    missing = [field_type for field_type in dict.fromkeys(types) if field_type not in field_type_examples]
+    if missing:
+        with retrieval_lock:
+            # The warm-up thread may have filled some of them while this one waited
+            missing = [field_type for field_type in missing if field_type not in field_type_examples]
+            if missing:
+                queries = [f"{field_type} sling:resourceType granite field properties" for field_type in missing]
+                results = get_collection().query(
+                    query_texts=queries,
+                    n_results=TOP_K,
+                    include=["documents", "distances"]
+                )
+                for field_type, fields_query, docs, distances in zip(missing, queries, results["documents"], results["distances"]):
+                    # Always keep the closest chunk, further ones only while close enough (adaptive top-k)
+                    kept = [doc for i, (doc, distance) in enumerate(zip(docs, distances)) if i == 0 or distance <= MAX_DISTANCE]
+                    
+                    if RERANK and len(kept) > 1:
+                        scores = get_reranker().predict([(fields_query, doc) for doc in kept])
+                        kept = [doc for _, doc in sorted(zip(scores, kept), key=lambda pair: pair[0], reverse=True)][:RERANK_TOP_N]
+                    field_type_examples[field_type] = tuple(kept)
+    return {field_type: field_type_examples[field_type] for field_type in types}
+
+@lru_cache(maxsize=256)
+def query_knowledge_base(field_types_key):
+    """
+    Assemble field examples for a sorted tuple of field types from the per-type
+    table. Results are cached in-process, since they only depend on the field types.
+    """
+    if not field_types_key:
+        return {"fields_context": ""}
+    
+    examples = lookup_field_types(field_types_key)
+    candidates = [(field_type, docs[0], True) for field_type, docs in examples.items() if docs]
+    candidates += [(field_type, doc, False) for field_type, docs in examples.items() for doc in docs[1:]]
+    
+    # Every type's closest example is sent; further chunks only while both the type's
+    # and the overall token budget allow. Near-duplicate chunks are skipped.
+    # All candidates are tokenized in one encode_batch call (parallel, outside the GIL)
+    token_counts = [len(ids) for ids in get_token_encoder().encode_batch([doc for _, doc, _ in candidates])]
+    seen, context_docs, total_tokens = set(), [], 0
+    type_tokens = dict.fromkeys(examples, 0)
+    for (field_type, doc, is_closest), doc_tokens in zip(candidates, token_counts):
+        doc_key = doc[:200]
+        if doc_key in seen:
+            continue
+        if not is_closest and (
+            type_tokens[field_type] + doc_tokens > TYPE_CONTEXT_TOKENS
+            or total_tokens + doc_tokens > MAX_CONTEXT_TOKENS
+        ):
+            continue
+        seen.add(doc_key)
+        context_docs.append(doc)
+        type_tokens[field_type] += doc_tokens
+        total_tokens += doc_tokens
+    return {"fields_context": "\n\n".join(context_docs)}
 
-**IMPORTANT FOR MULTIFIELD:**
-If a Multifield is in "Fields to implement" AND context specifies child fields:
+def retrieve_targeted_context(field_types_key):
+    """
+    Retrieve field-type examples from the knowledge base for a sorted tuple of field types
+    """
+    try:
+        all_retrieved = dict(query_knowledge_base(field_types_key))
+        
+        # Log what was retrieved (sizes only, never the chunk text)
+        if DEBUG:
+            print(f"📚 Retrieved contexts:")
+            for key, value in all_retrieved.items():
+                print(f"  - {key}: {len(value)} chars (~{len(value) // 4} tokens)")
+        
+        return all_retrieved
+        
+    except Exception as e:
+        print(f"❌ RAG Error: {str(e)}")
+        return {"fields_context": ""}
+        
+# --- UI Field Options ---
+field_types = [
+    "RTE Text Field",
+    "Drop down Field (Select)",
+    "Tags picker",
+    "Text Field",
+    "Text Area",
+    "Password Field",
+    "Number Field",
+    "Email Field",
+    "Date Picker",
+    "Color Field",
+    "Check Box",
+    "Path Field",
+    "Multifield"
+]
 
-DIALOG STRUCTURE:
-```
-<items jcr:primaryType="nt:unstructured"
-       sling:resourceType="granite/ui/components/coral/foundation/form/multifield"
-       fieldLabel="Add Items">
-    <field jcr:primaryType="nt:unstructured"
-           sling:resourceType="granite/ui/components/coral/foundation/container"
-           name="./items">
-        <items jcr:primaryType="nt:unstructured">
-            <text .../>  <!-- Child fields go here -->
-            <number .../>
-            <path .../>
-        </items>
-    </field>
-</items>
-```
 
-SLING MODEL:
-```
-@ChildResource(name = "items")
-private List<Resource> items;
+# --- Gradio callbacks ---
+# fields_data lives in per-session gr.State, not a module global; the extra
+# context is read straight from the textbox when generating.
+# fields_data is a dict keyed by field name (insertion-ordered), so duplicate
+# names are rejected with a lookup instead of a scan.
+# The callbacks do no blocking work, so they are async and run on the event loop
+# instead of being dispatched to a worker thread.
+
+# Field names are JCR property names: an optional ./ prefix (the usual dialog
+# name form), then name segments, optionally namespaced like jcr:title
+FIELD_NAME_PATTERN = re.compile(r"(?:\./)?[A-Za-z_][A-Za-z0-9_-]*(?::[A-Za-z_][A-Za-z0-9_-]*)*")
+
+async def add_field(selected_type, field_name, field_label, current_list, fields_data):
+    # Validate once here, so generation never spends a completion on an unusable field
+    field_name = (field_name or "").strip()
+    field_label = (field_label or "").strip()
+    if not field_name or not field_label:
+        return current_list, "⚠️ Please enter both a field name and label.", fields_data
+    if not FIELD_NAME_PATTERN.fullmatch(field_name):
+        return current_list, f"⚠️ `{field_name}` is not a valid field name, use letters, digits, `_` or `-` (not starting with a digit), optionally namespaced like `jcr:title` or prefixed with `./`.", fields_data
+    if field_name in fields_data:
+        return current_list, f"⚠️ A field named `{field_name}` already exists.", fields_data
 
-public List<Resource> getItems() {{
-    return items;
-}}
-```
-NO separate @ValueMapValue fields for text/number/path - those are accessed via items.get(i).getValueMap().get("text")
+    fields_data = {**fields_data, field_name: {
+        "type": selected_type,
+        "name": field_name,
+        "label": field_label
+    }}
 
-HTL ACCESS:
-```
-<ul data-sly-list.item="${{model.items}}">
-    <li>${{item.valueMap.text}} - ${{item.valueMap.number}} - ${{item.valueMap.path}}</li>
-</ul>
-```
+    new_entry = f"🧩 **{selected_type}** – Label: `{field_label}`, Name: `{field_name}`"
+    if current_list == "### 📋 Fields Added\n_(No fields added yet)_":
+        updated_list = f"### 📋 Fields Added\n\n{new_entry}"
+    else:
+        updated_list = current_list + "\n\n" + new_entry
 
-**SLING MODEL GENERATION CHECKLIST:**
-Before generating the Sling Model, verify you are:
-- ✓ Using the EXACT @Model annotation with ALL parameters from the knowledge base pattern
-- ✓ Including the EXACT import statements from the pattern
-- ✓ Using the EXACT package structure style from the pattern  
-- ✓ Following the EXACT annotation style for each field (@ValueMapValue, @Default, etc.)
-- ✓ Creating @ValueMapValue fields for EVERY component-level field from "Fields to implement" (count them and verify!)
-- ✓ Field names in Sling Model MUST match the "name" attribute from dialog exactly
-- ✓ For multifield: Creating POJO inner class + @PostConstruct init pattern
-- ✓ POJO fields match multifield child field names (e.g., itemText, itemNumber) NOT component field names (e.g., text)
-- ✓ Creating getter methods for ALL fields (component + multifield)
-- ✓ Multifield getter returns List<PojoClass>, NOT List<Resource>
-- ✓ Including only getter methods (no setters unless pattern shows them)
+    return updated_list, f"✅ Added {selected_type} field successfully.", fields_data
 
-**HTL GENERATION CHECKLIST:**
-Before generating HTL, verify you are:
-- ✓ Using data-sly-use to bind the Sling Model
-- ✓ Displaying ALL component-level fields from "Fields to implement" (count them and verify!)
-- ✓ Using ${{model.fieldName}} syntax for component fields
-- ✓ For multifield: Using data-sly-list to iterate the POJO list
-- ✓ Accessing multifield child fields via item POJO (e.g., ${{item.itemText}})
-- ✓ Not confusing component field names with multifield child field names
 
-**OUTPUT FORMAT:**
-Return valid JSON only:
-{{
-  "dialog": "<complete dialog XML>",
-  "sling_model": "<complete Java Sling Model>",
-  "htl": "<complete HTL template>"
-}}"""
+async def reset_fields():
+    return "### 📋 Fields Added\n_(No fields added yet)_", "", "", "", "", {}, "", ""
 
-    print("🤖 Generating code...")
-    print(f"📊 Context lengths - Dialog: {len(rag_context['dialog_context'])} chars, Sling: {len(rag_context['sling_context'])} chars")
-    
-    try:
-        # Use higher temperature for better adaptation while maintaining structure
-        response = client.chat.completions.create(
+
+async def set_context_chat(prompt):
+    return f"🧠 Context added successfully:\n> {prompt}"
+
+# Generated code keyed by request_cache_key(), least recently used evicted first
+answer_cache = OrderedDict()
+
+def request_cache_key(full_prompt):
+    """
+    Hash the complete request as sent to the model: prompts (including the
+    retrieved context), output format, models and sampling parameters. Editing a
+    template, the knowledge base or a setting changes the key, so stale answers
+    are never served.
+    """
+    if GENERATION_MODE == "parallel":
+        request = [
+            [ARTIFACT_MODELS[key], ARTIFACT_MAX_TOKENS, output_format]
+            for key, output_format in ARTIFACT_OUTPUT_FORMATS.items()
+        ]
+    else:
+        request = [GEN_MODEL, MAX_OUTPUT_TOKENS, JSON_OUTPUT_FORMAT, ARTIFACT_SCHEMA]
+    return hashlib.sha256(orjson.dumps(
+        [GENERATION_MODE, GENERATION_TEMPERATURE, SYSTEM_PROMPT, full_prompt, request]
+    )).hexdigest()
+
+os.makedirs(CHROMA_DB_DIR, exist_ok=True)
+answer_db = sqlite3.connect(ANSWER_CACHE_PATH, check_same_thread=False)
+answer_db.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, answer BLOB, created REAL)")
+
+def touch_answer(cache_key):
+    # "created" holds the last use, so the disk tier evicts by recency like the LRU
+    with answer_db:
+        answer_db.execute("UPDATE answers SET created = ? WHERE key = ?", (time.time(), cache_key))
+
+def load_cached_answer(cache_key):
+    """Return the cached (dialog, sling_model, htl) for a key, from memory or disk, or None."""
+    if cache_key in answer_cache:
+        answer_cache.move_to_end(cache_key)
+        touch_answer(cache_key)
+        return answer_cache[cache_key]
+    row = answer_db.execute(
+        "SELECT answer FROM answers WHERE key = ?", (cache_key,)
+    ).fetchone()
+    if not row:
+        return None
+    touch_answer(cache_key)
+    answer_cache[cache_key] = tuple(orjson.loads(row[0]))
+    while len(answer_cache) > ANSWER_CACHE_SIZE:
+        answer_cache.popitem(last=False)
+    return answer_cache[cache_key]
+
+def store_answer(cache_key, answer):
+    answer_cache[cache_key] = answer
+    while len(answer_cache) > ANSWER_CACHE_SIZE:
+        answer_cache.popitem(last=False)
+    with answer_db:
+        answer_db.execute(
+            "INSERT OR REPLACE INTO answers (key, answer, created) VALUES (?, ?, ?)",
+            (cache_key, orjson.dumps(answer), time.time())
+        )
+        answer_db.execute(
+            "DELETE FROM answers WHERE key NOT IN (SELECT key FROM answers ORDER BY created DESC LIMIT ?)",
+            (ANSWER_DISK_CACHE_SIZE,)
+        )
+
+ARTIFACT_KEY_PATTERN = re.compile(r'"(dialog|sling_model|htl)"\s*:\s*"')
+# Longest run of complete JSON string content: plain characters or whole escape sequences
+STRING_BODY_PATTERN = re.compile(r'(?:[^"\\]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*')
+
+class PartialArtifactParser:
+    """
+    Incrementally decode the dialog/sling_model/htl strings of a streamed JSON
+    response so they can be shown before it completes. Each delta is scanned
+    once; an escape sequence cut at the end of a delta is held back until the
+    next one, so the decoded values only ever grow.
+    """
+    def __init__(self):
+        self.values = {}
+        self.key = None
+        self.tail = ""
+
+    def feed(self, delta):
+        self.tail += delta
+        while True:
+            if self.key is None:
+                match = ARTIFACT_KEY_PATTERN.search(self.tail)
+                if not match:
+                    return self.values
+                self.key = match.group(1)
+                self.values[self.key] = ""
+                self.tail = self.tail[match.end():]
+            
+            end = STRING_BODY_PATTERN.match(self.tail).end()
+            if end:
+                try:
+                    self.values[self.key] += orjson.loads(f'"{self.tail[:end]}"')
+                except orjson.JSONDecodeError:
+                    # Surrogate pair split across deltas, wait for its second half
+                    return self.values
+                self.tail = self.tail[end:]
+            if not self.tail.startswith('"'):
+                # Value continues in the next delta
+                return self.values
+            self.key = None
+            self.tail = self.tail[1:]
+
+LEADING_FENCE_PATTERN = re.compile(r"^\s*```[\w-]*\n?")
+TRAILING_FENCE_PATTERN = re.compile(r"\n?```\s*$")
+
+async def stream_json_artifacts(full_prompt):
+    """
+    Generate all artifacts in one JSON-mode completion. Yields the partially
+    decoded artifacts while streaming, then the fully parsed response.
+    """
+    ai_output = ""
+    finish_reason = None
+    parser = PartialArtifactParser()
+    last_update = 0.0
+    async with openai_slots:
+        stream = await client.chat.completions.create(
             model=GEN_MODEL,
-            temperature=0.4,
+            temperature=GENERATION_TEMPERATURE,
+            max_tokens=MAX_OUTPUT_TOKENS,
             messages=[
                 {
                     "role": "system", 
-                    "content": "You are an expert AEM developer. Generate code that implements user requirements exactly, using knowledge base examples as structural patterns. Prioritize user requirements over example patterns when they conflict. CRITICAL: Never omit fields from 'Fields to implement' list - all component-level fields must be included in Dialog XML, Sling Model (@ValueMapValue), and HTL (model.fieldName). If similar field types appear in both component fields and multifield context, include BOTH with different names: component field gets @ValueMapValue, multifield child goes in POJO only."
+                    "content": SYSTEM_PROMPT
                 },
                 {
                     "role": "user", 
-                    "content": full_prompt
+                    "content": f"{full_prompt}\n\n{JSON_OUTPUT_FORMAT}"
                 },
             ],
-            response_format={"type": "json_object"}
+            response_format={"type": "json_schema", "json_schema": ARTIFACT_SCHEMA},
+            stream=True
         )
+    
+        # Show each section in its tab while the JSON is still streaming in.
+        # Closing the stream on cancellation drops the connection, which stops the completion
+        async with stream:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                if not chunk.choices[0].delta.content:
+                    continue
+                ai_output += chunk.choices[0].delta.content
+                partial = parser.feed(chunk.choices[0].delta.content)
+                if time.monotonic() - last_update >= STREAM_UPDATE_SECONDS:
+                    last_update = time.monotonic()
+                    yield dict(partial)
+    
+    # A cut-off response could still be "repaired" into valid JSON with truncated code
+    if finish_reason == "length":
+        raise ValueError(f"Generation stopped at the {MAX_OUTPUT_TOKENS}-token output limit, the code is incomplete.")
+    
+    try:
+        parsed = orjson.loads(ai_output)
+    except orjson.JSONDecodeError as e:
+        # Small syntax drift (trailing comma, raw newline in a string) is repaired
+        # locally instead of costing another completion
+        print(f"⚠️ JSON Error: {str(e)}, attempting repair")
+        try:
+            parsed = orjson.loads(repair_json(ai_output))
+        except orjson.JSONDecodeError:
+            parsed = None
+        if not isinstance(parsed, dict):
+            print(f"Raw output preview: {ai_output[:500]}")
+            raise ValueError(f"JSON parsing error: {str(e)}\n\nRaw output:\n{ai_output[:500]}") from e
+    yield parsed
+
+async def stream_parallel_artifacts(full_prompt):
+    """
+    Generate each artifact in its own plain-code completion, all running
+    concurrently. Yields the combined artifacts whenever any stream advances.
+    """
+    artifacts = dict.fromkeys(ARTIFACT_OUTPUT_FORMATS, "")
+    updates = asyncio.Queue()
+    
+    async def generate_artifact(key, output_format):
+        text = ""
+        body_started = False
+        async with openai_slots:
+            stream = await client.chat.completions.create(
+                model=ARTIFACT_MODELS[key],
+                temperature=GENERATION_TEMPERATURE,
+                max_tokens=ARTIFACT_MAX_TOKENS,
+                messages=[
+                    {
+                        "role": "system", 
+                        "content": SYSTEM_PROMPT
+                    },
+                    {
+                        "role": "user", 
+                        "content": f"{full_prompt}\n\n**OUTPUT FORMAT:**\n{output_format}"
+                    },
+                ],
+                stream=True
+            )
+            # Closing the stream on cancellation drops the connection, which stops the completion
+            async with stream:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    if chunk.choices[0].finish_reason == "length":
+                        raise ValueError(f"Generation of {key} stopped at the {ARTIFACT_MAX_TOKENS}-token output limit, the code is incomplete.")
+                    if not chunk.choices[0].delta.content:
+                        continue
+                    text += chunk.choices[0].delta.content
+                    if not body_started:
+                        # Hold the text back until it is clear whether it opens with a
+                        # ``` fence line, then strip that fence once
+                        head = text.lstrip()
+                        if "\n" not in head and "```".startswith(head[:3]):
+                            continue
+                        text = LEADING_FENCE_PATTERN.sub("", text, count=1)
+                        body_started = True
+                    artifacts[key] = text
+                    await updates.put(None)
+        
+        # The closing fence can only be recognised once the stream has ended
+        if not body_started:
+            text = LEADING_FENCE_PATTERN.sub("", text, count=1)
+        artifacts[key] = TRAILING_FENCE_PATTERN.sub("", text, count=1)
+    
+    tasks = []
+    for key, output_format in ARTIFACT_OUTPUT_FORMATS.items():
+        task = asyncio.create_task(generate_artifact(key, output_format))
+        # Finished tasks are posted to the queue too, so a failure is seen right away
+        task.add_done_callback(updates.put_nowait)
+        tasks.append(task)
+    try:
+        pending = len(tasks)
+        last_update = 0.0
+        while pending:
+            update = await updates.get()
+            if update is not None:
+                pending -= 1
+                # One failed artifact fails the whole generation; the finally below
+                # cancels the sibling completions instead of letting them burn tokens
+                update.result()
+            elif time.monotonic() - last_update < STREAM_UPDATE_SECONDS:
+                continue
+            last_update = time.monotonic()
+            yield dict(artifacts)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def generate_sling_model_with_rag(fields, user_context):
+    """
+    Generate code using knowledge base as reference patterns, not rigid templates
+    """
+    if not fields:
+        yield ("⚠️ Please add at least one field before generating.", "", "")
+        return
+
+    # Normalize whitespace so resubmitting the same context with stray spaces or
+    # blank lines builds the same prompt and hits the answer cache
+    user_context = "\n".join(line.strip() for line in (user_context or "").splitlines() if line.strip())
+
+    # Build field requirements (single pass: list, unique types, multifields)
+    fields_list = []
+    field_type_set = set()
+    multifield_info = {}
+    
+    for f in fields.values():
+        fields_list.append({
+            "type": f['type'],
+            "name": f['name'],
+            "label": f['label']
+        })
+        field_type_set.add(f['type'])
+        # Track multifield for special handling
+        if f['type'] == "Multifield":
+            multifield_info[f['name']] = {
+                "label": f['label'],
+                "child_fields": []
+            }
+    
+    # Compact JSON: the model does not need the indentation, the prompt saves the tokens
+    fields_json = orjson.dumps(fields_list).decode("utf-8")
+    
+    # Detect tab organization from context
+    tab_instructions = ""
+    # Check for any tab-related keywords
+    if user_context and TAB_MENTION_PATTERN.search(user_context):
+        # Extract all mentioned tab names from context (title-cased below, so case is irrelevant)
+        detected_tabs = []
+        for pattern in TAB_NAME_PATTERNS:
+            matches = pattern.findall(user_context)
+            detected_tabs.extend([m.strip().title() for m in matches if m.strip()])
+        
+        # Remove duplicates while preserving order
+        detected_tabs = list(dict.fromkeys(detected_tabs))
+        
+        tab_analysis = f"Detected tab names from context: {', '.join(detected_tabs) if detected_tabs else 'No explicit names found'}"
         
-        ai_output = response.choices[0].message.content
+        tab_instructions = TAB_INSTRUCTIONS_TEMPLATE.format_map({"tab_analysis": tab_analysis})
+    
+    # Parse multifield child fields from context if mentioned
+    multifield_context_note = ""
+    if multifield_info and user_context:
+        # Extract component-level field names to avoid conflicts
+        component_field_names = [f['name'] for f in fields_list]
         
-        # Parse JSON response
-        parsed = json.loads(ai_output)
+        multifield_context_note = MULTIFIELD_NOTE_TEMPLATE.format_map({
+            "multifield_names": ", ".join(multifield_info),
+            "component_field_names": component_field_names,
+        })
+    
+    # Retrieve relevant context
+    print("🔍 Retrieving context from trained knowledge base...")
+    # Chroma's query API is sync, so run it off the event loop
+    # Sorted so the retrieval cache key is stable
+    rag_context = await asyncio.to_thread(retrieve_targeted_context, tuple(sorted(field_type_set)))
+    
+    # Build the per-request part of the prompt (static rules live in SYSTEM_PROMPT)
+    full_prompt = USER_PROMPT_TEMPLATE.format_map({
+        "fields_json": fields_json,
+        "user_context": user_context or "No additional requirements - use standard AEM best practices.",
+        "tab_instructions": tab_instructions,
+        "multifield_context_note": multifield_context_note,
+        "fields_context": rag_context['fields_context'] or "Use standard Granite UI field types",
+    })
+    
+    # An identical request always gets the same kind of answer, so reuse the last one
+    cache_key = request_cache_key(full_prompt)
+    cached_answer = load_cached_answer(cache_key)
+    if cached_answer:
+        print("♻️ Returning cached code for identical request")
+        yield cached_answer
+        return
+
+    print("🤖 Generating code...")
+    if DEBUG:
+        print(f"📊 Context length - Fields: {len(rag_context['fields_context'])} chars")
+    
+    try:
+        stream_artifacts = stream_parallel_artifacts if GENERATION_MODE == "parallel" else stream_json_artifacts
+        parsed = {}
+        async for parsed in stream_artifacts(full_prompt):
+            yield (parsed.get("dialog", ""), parsed.get("sling_model", ""), parsed.get("htl", ""))
 
         dialog = parsed.get("dialog", "").strip()
         sling_model = parsed.get("sling_model", "").strip()
@@ -813,27 +1500,31 @@ Return valid JSON only:
         
         # Validation
         if not dialog:
-            return ("❌ Failed to generate dialog", "", "")
+            yield ("❌ Failed to generate dialog", "", "")
+            return
         if not sling_model:
-            return ("❌ Failed to generate Sling Model", dialog, "")
+            yield ("❌ Failed to generate Sling Model", dialog, "")
+            return
         if not htl:
-            return ("❌ Failed to generate HTL", dialog, sling_model)
+            yield ("❌ Failed to generate HTL", dialog, sling_model)
+            return
         
         print("✅ Code generated successfully")
-        return (dialog, sling_model, htl)
+        store_answer(cache_key, (dialog, sling_model, htl))
+        yield (dialog, sling_model, htl)
         
-    except json.JSONDecodeError as e:
-        print(f"JSON Error: {str(e)}")
-        print(f"Raw output preview: {ai_output[:500]}")
-        return (f"❌ JSON parsing error: {str(e)}\n\nRaw output:\n{ai_output[:500]}", "", "")
+    except ValueError as e:
+        yield (f"❌ {str(e)}", "", "")
     except Exception as e:
         print(f"Generation error: {str(e)}")
-        return (f"❌ Error generating code: {str(e)}", "", "")
+        yield (f"❌ Error generating code: {str(e)}", "", "")
         
 # --- Gradio Interface ---
 with gr.Blocks(theme="soft", title="AEM Component Builder") as demo:
     gr.Markdown("# 🧩 AEM Component Builder")
 
+    fields_state = gr.State({})
+
     with gr.Row():
         with gr.Column(scale=2):
             field_type = gr.Dropdown(
@@ -868,7 +1559,7 @@ with gr.Blocks(theme="soft", title="AEM Component Builder") as demo:
         lines=3
     )
     context_status = gr.Markdown("")
-    context_input.submit(set_context_chat, inputs=[context_input], outputs=[context_status])
+    context_input.submit(set_context_chat, inputs=[context_input], outputs=[context_status], queue=False)
 
     gr.Markdown("---")
     generate_btn = gr.Button("🚀 Generate AEM Component Code", variant="primary", size="lg")
@@ -885,23 +1576,44 @@ with gr.Blocks(theme="soft", title="AEM Component Builder") as demo:
         htl_output = gr.Code(label="HTL Template", language="html", lines=20)
 
     # Event handlers
+    # LLM generations get their own concurrency group; the cheap UI events below
+    # skip the queue entirely and answer over plain HTTP
     generate_btn.click(
-        fn=lambda user_ctx: generate_sling_model_with_rag(fields_data, user_ctx),
-        inputs=[context_input],
+        fn=generate_sling_model_with_rag,
+        inputs=[fields_state, context_input],
         outputs=[dialog_output, sling_output, htl_output],
+        concurrency_limit=QUEUE_CONCURRENCY,
+        concurrency_id="llm",
     )
 
     reset_btn.click(
         fn=reset_fields,
         inputs=[],
-        outputs=[field_list, status, dialog_output, sling_output, htl_output],
+        outputs=[field_list, status, dialog_output, sling_output, htl_output, fields_state, context_input, context_status],
+        queue=False,
     )
 
     add_btn.click(
         fn=add_field,
-        inputs=[field_type, field_name, field_label, field_list],
-        outputs=[field_list, status, gr.State(fields_data)],
+        inputs=[field_type, field_name, field_label, field_list, fields_state],
+        outputs=[field_list, status, fields_state],
+        queue=False,
     )
 
 
-demo.launch(share=False)
\ No newline at end of file
+def warm_field_type_cache():
+    """Fill the per-type table for every dropdown type in one batched query, so generation never waits on a vector search."""
+    try:
+        lookup_field_types(field_types)
+        print(f"✅ Field examples cached for {len(field_types)} field types.")
+    except Exception as e:
+        print(f"❌ RAG warm-up error: {str(e)}")
+
+if "--build-index" in sys.argv:
+    # Offline indexing: `python ai_agent_new_4.py --build-index` embeds via the Batch API and exits
+    build_or_load_chroma(use_batch_api=True)
+else:
+    # Warm in the background so the UI is reachable immediately
+    threading.Thread(target=warm_field_type_cache, daemon=True).start()
+    # Generation is dominated by waiting on OpenAI, so let several sessions' requests overlap
+    demo.queue(default_concurrency_limit=QUEUE_CONCURRENCY, max_size=QUEUE_MAX_SIZE).launch(share=False)
\ No newline at end of file